@@ -6,17 +6,87 @@
 # Amaury Dehecq
 # 03/2019
 
+import hashlib
+import io
 import os
-import sys
+import re
+import shlex
+from functools import lru_cache
 from tempfile import NamedTemporaryFile
-import traceback
 import subprocess
 from packaging import version
 
 
+# Cached version of os.path.normpath. Workflows typically reference the
+# same paths in many rules (e.g. a common input file), so normalizing each
+# unique path only once saves repeated work in check_args_inout/output.
+# Safe because normpath is a pure string operation.
+_normpath = lru_cache(maxsize=8192)(os.path.normpath)
+
+
+# Fixed makefile boilerplate, assembled once at import time:
+# PHONY declaration, single-shell execution and colors for commands
+# highlighting. With .ONESHELL, all the commands of a rule run in one
+# shell invocation instead of make forking one shell per line; -e keeps
+# the per-line semantics of stopping the rule on the first failure.
+_HEADER_PRE = (".PHONY: MAIN\n"
+               ".ONESHELL:\n"
+               "SHELL := /bin/bash\n"
+               ".SHELLFLAGS := -eu -o pipefail -c\n\n"
+               "CMDCOL := [32m\n"
+               "DEFCOL := [0m\n\n")
+
+# Optional block displaying a title at the beginning of the execution
+_PREBUILD_FMT = "pre-build:\n\t@+printf '%s\\n'\n\n"
+
+# Pieces of the per-rule title recipe line, around the escaped title.
+# Kept as constants so the hot path of _format_rule appends the three
+# pieces as is instead of allocating a formatted string per rule.
+_TITLE_PREFIX = "\t@printf '"
+_TITLE_SUFFIX = "\\n'\n"
+
+# Target to list missing outputs, call with 'make list'
+# A single awk filters and strips the debug output in one pass, instead
+# of a pipeline of three sed processes
+_LIST_TARGET = ("list:\n"
+                "\t@printf '** Missing outputs **\\n'\n"
+                "\t@$(MAKE) -n --debug -f $(lastword $(MAKEFILE_LIST)) | "
+                "awk '/Must remake target/ && !/MAIN/ && !/pre-build/ "
+                "{sub(/^.*Must remake target /,\"\"); print}'\n\n")
+
+
+# Recipe line turning the strace output of an auto_deps rule into a .d
+# dependency fragment under deps/: keep the relative paths opened by the
+# commands (ignoring failed opens and the target itself), one fragment
+# per target. $$2 and $$( reach the shell as $2 and $(.
+# Like the content stamps, the fragment name encodes the full target
+# path (slashes replaced), so same-named outputs in different
+# directories get distinct fragments.
+_AUTO_DEPS_RECIPE = (
+    "\t@mkdir -p deps; "
+    "printf '%s: %s\\n' '$@' "
+    "\"$$(awk -F'\"' '/openat/ && !/ENOENT/ && $$2 ~ /^[^\\/]/ "
+    "&& $$2 != \"$@\" {print $$2}' $@.trace.* | sort -u | tr '\\n' ' ')\" "
+    "> deps/$(subst /,_,$@).d; rm -f $@.trace.*\n")
+
+
+# Cache for get_make_version, so make -v is run at most once per process
+_MAKE_VERSION = None
+
+# For make > 4.3, grouped targets can be set explicitly with &:
+# The comparison result is cached lazily in _is_new_make
+_VERSION_4_3 = version.parse('4.3')
+_NEW_VERSION = None
+
+# --output-sync only exists from make 4.0 on
+_VERSION_4_0 = version.parse('4.0')
+
+
 def get_make_version():
     """
     Get make version number.
+    The result is cached at module level, so make is only spawned once
+    even if many Workflow objects are created.
     Output of make -v is expected to be something like:
 
     GNU Make X.X.X
@@ -26,28 +96,45 @@ def get_make_version():
 
     where X.X.X is the version number.
     """
-    # Run make -v and save output
-    process = subprocess.Popen(['make', '-v'], stdout=subprocess.PIPE)
-    stdout = process.communicate()[0]
+    global _MAKE_VERSION
+    if _MAKE_VERSION is not None:
+        return _MAKE_VERSION
 
-    # Convert default Byte type to string
-    stdout = stdout.decode('utf-8')
+    # Run make -v and save output
+    # subprocess.run with an argv list avoids going through a shell and
+    # lets CPython use the cheaper posix_spawn instead of fork
+    stdout = subprocess.run(['make', '-v'], capture_output=True,
+                            text=True, check=True).stdout
 
     # Get first line containing version number
-    fline = stdout.split('\n')[0]
+    # partition/rpartition slice the string without building line/token lists
+    fline = stdout.partition('\n')[0]
 
     # Get last item containing version number
-    vnum = fline.split(' ')[-1]
+    vnum = fline.rpartition(' ')[2]
 
     # Convert to a version object for comparison
-    make_version = version.parse(vnum)
+    _MAKE_VERSION = version.parse(vnum)
 
-    return make_version
+    return _MAKE_VERSION
+
+
+def _is_new_make():
+    """
+    Check whether the installed make is newer than 4.3, i.e. supports
+    grouped targets. Resolved once per process and cached.
+    """
+    global _NEW_VERSION
+    if _NEW_VERSION is None:
+        _NEW_VERSION = get_make_version() > _VERSION_4_3
+    return _NEW_VERSION
 
 
 class Workflow():
 
-    def __init__(self, filename=None, title=None, overwrite=False):
+    def __init__(self, filename=None, title=None, overwrite=False,
+                 assume_new_make=None, cache_dir=None, targets=None,
+                 backend='make'):
         """
         Used to initialize the makefile.
         Will generate a main function for the makefile.
@@ -55,72 +142,313 @@ class Workflow():
         filename: str, path to the makefile (Default is None, i.e. generate a temporary file)
         title: string to display at the beginning of the execution
         overwrite: if set to True, will overwrite an existing makefile.
+        assume_new_make: bool, set to True/False to skip the detection of the
+        make version and force the new (grouped targets) or old (single
+        output) rule format, e.g. for reproducibility on CI. Default is None,
+        i.e. detect by running make -v.
+        cache_dir: str, path to a persistent artifact cache. Single-output
+        rules are then keyed on their commands and the content of their
+        inputs: if the key is found in the cache the output is copied from
+        there instead of re-running the commands, otherwise the commands
+        run and the result populates the cache. Outputs are so reused across runs and across
+        workflows sharing the same cache.
+        targets: str or list, final targets of the workflow, if known
+        upfront. The MAIN line is then written once here and append() skips
+        the MAIN bookkeeping entirely, making it a pure append operation
+        (the MAIN update branches become dead code for such workflows).
+        backend: str, build tool to generate for and run, 'make' (default)
+        or 'ninja'. Ninja parses large files and schedules jobs with much
+        less overhead than make, which helps workflows with very many
+        rules. The ninja backend only generates new files and does not
+        support the make-specific options (content_hash, cache_dir,
+        templates, clean and the force/clean flags of run).
         """
 
-        # Create and open temporary file
+        # Choose the build backend
+        if backend not in ('make', 'ninja'):
+            raise ValueError("backend must be 'make' or 'ninja', got %r"
+                             % (backend,))
+        self.backend = backend
+
+        # Check which rule format to use
+        # Irrelevant for ninja, which always supports multiple outputs
+        if backend == 'make':
+            self._detect_make_features(assume_new_make)
+        else:
+            self.new_version = True
+
+        # Precompiled rule templates, see register_template
+        self._templates = {}
+
+        # Rules already emitted, to skip duplicates in append()
+        self._seen = set()
+
+        # Whether the -include line for auto_deps fragments was written
+        self._auto_deps_included = False
+
+        # Optional artifact cache, see docstring
+        self._cache_dir = cache_dir
+
+        # With explicit targets, the MAIN line is final from the start and
+        # append() never has to update it
+        self._targets_frozen = targets is not None
+
+        # Create temporary file
         if filename is None:
             tmpf = NamedTemporaryFile(mode='w+')
             filename = tmpf.name
-            f = tmpf.file
             self.tmpf = tmpf   # Keep otherwise file will be deleted
             self.filename = tmpf.name
 
         # Open chosen file
         else:
-            # Just open the file in append mode.
+            # Just open an existing file and locate its MAIN line.
             # Won't work for temporary files though as self.tmpf is deleted.
             if os.path.exists(filename) & (not overwrite):
-                f = open(filename, 'a+')  # append and writing
-                f.seek(0)
+                if backend == 'ninja':
+                    raise ValueError("backend='ninja' cannot append to an "
+                                     "existing file, set overwrite=True")
+                f = open(filename, 'r+')  # reading and in-place writing
                 self.filename = filename
                 self.f = f
+                self._buffered = False
+                self._main_dirty = False
+                self._locate_main()
+                # New rules are appended through a raw O_APPEND descriptor:
+                # one unbuffered, atomic write syscall per append, while
+                # self.f keeps handling the in-place MAIN updates
+                self._append_fd = os.open(filename,
+                                          os.O_WRONLY | os.O_APPEND)
                 return
             else:
-                f = open(filename, 'w+')  # writing and reading
                 self.filename = filename
 
-        # Write header
-        f.write(".PHONY: MAIN\n\n")
+        # For new makefiles, all the text is accumulated in memory and only
+        # written to disk once, in _materialize(). This avoids many small
+        # write syscalls for workflows with thousands of rules.
+        self._buffered = True
+        self._buf = io.StringIO()
+
+        # Cache of the rendered text and state of the file on disk, so
+        # repeated run()/display() calls without new rules in between
+        # (e.g. dryrun then run, or successive runs from a notebook) do
+        # not re-render and re-write an unchanged makefile
+        self._rendered = None
+        self._synced = False
+
+        # Secondary outputs are collected here and emitted as a single
+        # consolidated .SECONDARY line at render time, instead of one
+        # line per rule
+        self._secondaries = []
+
+        # The default targets (the MAIN line for make) are generated at
+        # materialize time from self._main_outputs, so appends never
+        # rewrite previous text
+        # With explicit targets, the list is complete already
+        if self._targets_frozen:
+            self._main_outputs = check_args_output(targets)
+        else:
+            self._main_outputs = []
 
-        # Write colors for commands highlighting
-        f.write("CMDCOL := [32m\n")
-        f.write("DEFCOL := [0m\n\n")
+        # Ninja files have no header; rules are numbered as they come
+        if self.backend == 'ninja':
+            self._rule_count = 0
+            return
+
+        # Fixed part of the header, precomputed at module load
+        self._header_pre = _HEADER_PRE
 
-        # Write MAIN line, without title
         if title is None:
-            f.write("MAIN: \n\n")
+            self._main_prefix = "MAIN:"
+        else:
+            self._main_prefix = "MAIN: pre-build"
 
-        # with title
+        # Rest of the header: optional pre-build title block and the
+        # list target, both precomputed at module load
+        if title is not None:
+            self._header_post = "\n" + _PREBUILD_FMT % title + _LIST_TARGET
         else:
-            f.write("MAIN: pre-build \n\n")
-            f.write("pre-build:\n\t@+printf '%s\\n'\n\n" % title)
-
-        # Add a function to list missing outputs, call with 'make list'
-        f.write("list:\n")
-        f.write("\t@printf '** Missing outputs **\\n'\n")
-        f.write("\t@$(MAKE) -n --debug -f $(lastword $(MAKEFILE_LIST)) | \
-        sed -n -e 's/^.*Must remake target //p' | \
-        sed -e '/MAIN/d' | sed -e '/pre-build/d'\n\n")
-
-        # save
-        f.flush()
-        self.f = f
-
-        # Check if make version is newer than 4.3
-        make_version = get_make_version()
-        if make_version > version.parse('4.3'):
-            self.new_version = True
+            self._header_post = "\n" + _LIST_TARGET
+
+    def _detect_make_features(self, assume_new_make=None):
+        """
+        Set self.new_version, which selects between the grouped-targets
+        rule format (make > 4.3) and the single-output fallback.
+        If assume_new_make is given, use it as is and skip spawning
+        make -v entirely.
+        """
+        if assume_new_make is not None:
+            self.new_version = assume_new_make
         else:
-            self.new_version = False
+            self.new_version = _is_new_make()
+
+    def _write(self, text):
+        """
+        Write text to the in-memory buffer (new makefiles) or append it
+        to the file with a single raw write (existing makefiles).
+        """
+        if self._buffered:
+            self._buf.write(text)
+            self._rendered = None
+            self._synced = False
+        else:
+            os.write(self._append_fd, text.encode('utf-8'))
+
+    def __del__(self):
+        # For existing-makefile workflows, make sure a pending MAIN update
+        # reaches the file and close the raw append descriptor
+        fd = getattr(self, '_append_fd', None)
+        if fd is not None:
+            try:
+                self._flush_main()
+            except (ValueError, OSError):
+                pass  # file already closed at interpreter shutdown
+            os.close(fd)
+
+    def _materialize(self):
+        """
+        Write the buffered makefile to disk.
+        Called before running or displaying the makefile; just flushes when
+        appending to an existing file, as text is then written directly.
+        """
+        # Appended text is written unbuffered and _flush_main flushes the
+        # spliced MAIN line itself, so there is nothing else to sync
+        if not self._buffered:
+            self._flush_main()
+            return
+
+        # Nothing appended since the last materialize, file is up to date
+        if self._synced:
+            return
+
+        # Write header, MAIN line and all rules with a single raw write:
+        # the text is encoded once and goes straight to the kernel, without
+        # a Python file object's lock and buffer bookkeeping in between
+        fd = os.open(self.filename,
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC,
+                     0o644)
+        try:
+            os.write(fd, self._render().encode('utf-8'))
+        finally:
+            os.close(fd)
+        self._synced = True
+
+    def _render(self):
+        """
+        Return the complete makefile text of a buffered workflow:
+        header, MAIN line generated from the accumulated outputs, and
+        all the rules. For ninja, the rules followed by a default line.
+        The result is cached until the next append.
+        """
+        if self._rendered is not None:
+            return self._rendered
+        if self.backend == 'ninja':
+            parts = [self._buf.getvalue()]
+            if self._main_outputs:
+                parts.append("\ndefault %s\n"
+                             % ' '.join(self._main_outputs))
+            self._rendered = ''.join(parts)
+            return self._rendered
+
+        parts = [self._header_pre,
+                 ' '.join([self._main_prefix,
+                           *self._main_outputs, '\n']),
+                 self._header_post,
+                 self._buf.getvalue()]
+        if self._secondaries:
+            parts.append("\n.SECONDARY : %s\n"
+                         % ' '.join(self._secondaries))
+        self._rendered = ''.join(parts)
+        return self._rendered
+
+    def _locate_main(self):
+        """
+        Find the MAIN line in an existing makefile and record its offset,
+        prefix and current outputs, so append() can update it in place.
+        """
+        self.f.seek(0)
+        while True:
+            offset = self.f.tell()
+            line = self.f.readline()
+            if line == '':
+                break
+            if line[:4] == 'MAIN':
+                self._main_offset = offset
+                self._main_line_end = self.f.tell()
+                items = line.split()[1:]  # drop the 'MAIN:' token
+                if len(items) > 0 and items[0] == 'pre-build':
+                    self._main_prefix = "MAIN: pre-build"
+                    items = items[1:]
+                else:
+                    self._main_prefix = "MAIN:"
+                # Existing outputs, kept as a growing string so each update
+                # only appends the new outputs instead of re-joining all
+                self._main_suffix = ''.join(' ' + item for item in items)
+                return
+
+        # No MAIN line found, e.g. a hand-written makefile: fall back to
+        # starting a fresh one at the current end of the file, written out
+        # by the next _flush_main (rules appended in the meantime are
+        # shifted after it, like any other tail). Since MAIN is then not
+        # the first target of the file, it must be made the default goal
+        # explicitly for run() to build the appended rules.
+        self._main_offset = self.f.tell()
+        self._main_line_end = self._main_offset
+        # The leading newline also guards against a file not ending in one
+        self._main_prefix = ("\n.PHONY: MAIN\n"
+                             ".DEFAULT_GOAL := MAIN\n"
+                             "MAIN:")
+        self._main_suffix = ''
+
+    def _update_main(self, outputs):
+        """
+        Register new outputs for the MAIN line of an existing makefile.
+        The actual rewrite is deferred to _flush_main, so N appends pay a
+        single splice of the file instead of shifting its tail N times.
+        """
+        self._main_suffix += ''.join(' ' + output for output in outputs)
+        self._main_dirty = True
+
+    def _flush_main(self):
+        """
+        Rewrite the MAIN line of an existing makefile in place, if outputs
+        were added since the last flush. Only the MAIN line and the part of
+        the file after it are rewritten.
+        """
+        if not self._main_dirty:
+            return
+
+        # Read the part of the file after the MAIN line
+        self.f.seek(self._main_line_end)
+        tail = self.f.read()
+
+        # Rewrite the MAIN line and shift the tail
+        self.f.seek(self._main_offset)
+        self.f.write(self._main_prefix + self._main_suffix + ' \n')
+        self._main_line_end = self.f.tell()
+        self.f.write(tail)
+        self.f.truncate()
+        self.f.flush()
+        self._main_dirty = False
 
     def append(self, cmds, inputs, outputs,
-               title=None, secondary=False, soft_inputs=[], verbose=True):
+               title=None, secondary=False, soft_inputs=[], verbose=True,
+               content_hash=False, auto_deps=False):
         """
         Add a new list of commands to the Makefile with given outputs and inputs and display a title string at beginning of excution.
         Commands can be a single command or a list of commands.
         If secondary set to True, will consider all outputs of that command as secondary and the command won't be re-run if the files are deleted.
         soft_inputs are inputs that are necessary to run the command, but whose update will not force re-running the commands.
         If verbose set to False, will print stdout to /dev/null.
+        If content_hash set to True, the commands are only re-run when the
+        content of the inputs changes (checked with sha256sum), not when
+        their modification time does, so e.g. a touched but identical input
+        does not trigger a rebuild of all downstream steps.
+        If auto_deps set to True (experimental, make backend only, needs
+        strace), the commands are traced on their first run and the files
+        they actually open are recorded as extra dependencies in a deps/*.d
+        fragment, so e.g. a script referenced inside a command triggers a
+        rebuild without being declared in inputs.
         """
 
         # Make sure outputs are lists
@@ -130,42 +458,162 @@ class Workflow():
         inputs = check_args_inout(inputs)
         soft_inputs = check_args_inout(soft_inputs)
 
-        # Write target:deps line
+        # Make sure commands are lists
+        cmds = check_args_cmd(cmds)
+
+        # Skip rules already emitted with the exact same arguments, e.g.
+        # from composed pipeline fragments sharing steps. Re-emitting them
+        # would bloat the makefile and trigger make's 'overriding recipe'
+        # warnings; skipping is safe as running the same rule once or twice
+        # produces the same outputs. Every rule-affecting argument is part
+        # of the key, so a repeat differing in any of them (e.g. secondary,
+        # which decides whether the outputs go in MAIN) is not dropped.
+        key = (tuple(outputs), inputs, tuple(cmds), title, secondary,
+               soft_inputs, verbose, content_hash, auto_deps)
+        if key in self._seen:
+            return
+        self._seen.add(key)
+
+        # Build the rule text for the chosen backend and write it in one call
+        if self.backend == 'ninja':
+            self._write(self._format_ninja_rule(cmds, inputs, outputs,
+                                                title, soft_inputs, verbose))
+        else:
+            # Depend on a checksum stamp of the inputs instead of the inputs
+            if content_hash and len(inputs) > 0:
+                inputs = self._add_content_stamp(inputs, outputs)
+
+            # Pull in the traced dependency fragments, once per makefile
+            if auto_deps and not self._auto_deps_included:
+                self._write("\n-include deps/*.d\n")
+                self._auto_deps_included = True
+
+            self._write(self._format_rule(cmds, inputs, outputs, title,
+                                          secondary, soft_inputs, verbose,
+                                          auto_deps=auto_deps))
+
+        # Secondary outputs of buffered workflows go in the consolidated
+        # .SECONDARY line, emitted once at render time
+        if secondary and self._buffered:
+            self._secondaries.extend(outputs)
+
+        ## Need to update the MAIN function to add new outputs ##
+        # Only if outputs are not secondary (intermediate) files and the
+        # targets were not fixed at initialization
+        if not secondary and not self._targets_frozen:
+            if self._buffered:
+                self._main_outputs.extend(outputs)
+            else:
+                self._update_main(outputs)
+
+    def _add_content_stamp(self, inputs, outputs):
+        """
+        Write a rule creating a checksum stamp of the given inputs under
+        deps/, and return the stamp path to be used as dependency instead
+        of the inputs. The stamp is only rewritten when the checksums
+        change, so its modification time - and hence the downstream rule -
+        is untouched by content-preserving updates of the inputs.
+        The stamp name is derived from the full output path, so outputs
+        sharing a basename in different directories get distinct stamps.
+        """
+        stamp = os.path.join('deps',
+                             outputs[0].replace('/', '_') + '.sha')
+        self._write("\n%s : %s\n"
+                    "\t@mkdir -p deps; "
+                    "sha256sum $^ | cmp -s - $@ || sha256sum $^ > $@\n"
+                    % (stamp, inputs))
+        return stamp
+
+    def _format_rule(self, cmds, inputs, outputs, title, secondary,
+                     soft_inputs, verbose, use_cache=True, auto_deps=False):
+        """
+        Build the makefile text for one rule (target line, optional title,
+        commands and possible extra-output or .SECONDARY lines) and return
+        it as a single string. Arguments must already be normalized.
+        """
+        # Collect all the lines of the rule, then join them once
+        lines = []
+
+        # Target:deps line
         # For make > 4.3, grouped targets can be set explicitly with &:
         if self.new_version:
             if len(soft_inputs) > 0:
-                self.f.write("\n%s &: %s | %s\n" % (' '.join(outputs), inputs, soft_inputs))
+                lines.append("\n%s &: %s | %s\n" % (' '.join(outputs), inputs, soft_inputs))
             else:
-                self.f.write("\n%s &: %s\n" % (' '.join(outputs), inputs))
+                lines.append("\n%s &: %s\n" % (' '.join(outputs), inputs))
 
         # For make < 4.3, must have only one output
         # Additional outputs are added later
         else:
             if len(soft_inputs) > 0:
-                self.f.write("\n%s : %s | %s\n" % (outputs[0], inputs, soft_inputs))
+                lines.append("\n%s : %s | %s\n" % (outputs[0], inputs, soft_inputs))
             else:
-                self.f.write("\n%s : %s\n" % (outputs[0], inputs))
+                lines.append("\n%s : %s\n" % (outputs[0], inputs))
 
         # Add command for title
+        # No '+' prefix here: under .ONESHELL the prefixes of the first
+        # line apply to the whole recipe, and '+' would make dry runs
+        # execute the commands
         if title is not None:
-            self.f.write("\t@+printf '%s\\n'\n" % escape_char(title))
+            lines.append(_TITLE_PREFIX)
+            lines.append(escape_char(title))
+            lines.append(_TITLE_SUFFIX)
 
         # Add all commands
         cmds = check_args_cmd(cmds)
 
-        for cmd in cmds:
-            # Escape special characters
-            #cmd = escape_char(cmd)
-
-            # Add stdout option
-            if not verbose:
-                cmd += ' 1> /dev/null'
-
-            # print command with + symbol and green color
-            self.f.write("\t-@echo '${CMDCOL}+%s${DEFCOL}'\n" % cmd)
-
-            # command to be run
-            self.f.write("\t@%s\n" % cmd)
+        if not verbose:
+            cmds = [cmd + ' 1> /dev/null' for cmd in cmds]
+
+        # With an artifact cache, wrap single-output rules in a cache probe:
+        # on a hit the output is copied from the cache instead of re-running
+        # the commands, otherwise the commands run and populate the cache
+        if (use_cache and not auto_deps and self._cache_dir is not None
+                and len(outputs) == 1):
+            salt = hashlib.sha256(('; '.join(cmds) + '|' + inputs)
+                                  .encode('utf-8')).hexdigest()
+            cache = self._cache_dir
+            body = '; '.join("echo '${CMDCOL}+%s${DEFCOL}'; %s" % (cmd, cmd)
+                             for cmd in cmds)
+            if len(inputs) > 0:
+                # The key is computed at run time from the command hash and
+                # the *content* of the inputs ($^, i.e. without the
+                # order-only soft inputs), so a changed input can never hit
+                # a stale artifact
+                lines.append("\t@key=$$({ echo %s; sha256sum $^; } "
+                             "| sha256sum | cut -d' ' -f1); "
+                             "if [ -f %s/$$key ]; then "
+                             "echo \"${CMDCOL}+cp %s/$$key $@ "
+                             "(cached)${DEFCOL}\"; "
+                             "cp %s/$$key $@; "
+                             "else %s; mkdir -p %s; cp $@ %s/$$key; fi\n"
+                             % (salt, cache, cache, cache,
+                                body, cache, cache))
+            else:
+                # No inputs: the commands alone determine the output and
+                # the key is known already
+                cached = os.path.join(cache, salt)
+                lines.append("\t@if [ -f %s ]; then "
+                             "echo '${CMDCOL}+cp %s $@ (cached)${DEFCOL}'; "
+                             "cp %s $@; "
+                             "else %s; mkdir -p %s; cp $@ %s; fi\n"
+                             % (cached, cached, cached,
+                                body, cache, cached))
+        # With auto_deps, each command runs under strace so the files it
+        # opens can be recorded, and a final line turns the traces into a
+        # deps/*.d fragment picked up on the next parse
+        elif auto_deps:
+            for k, cmd in enumerate(cmds):
+                lines.append("\t@echo '${CMDCOL}+%s${DEFCOL}'; "
+                             "strace -qq -f -e trace=openat "
+                             "-o $@.trace.%d %s\n" % (cmd, k, cmd))
+            lines.append(_AUTO_DEPS_RECIPE)
+        else:
+            for cmd in cmds:
+                # print command with + symbol and green color, then run it,
+                # on a single recipe line
+                lines.append("\t@echo '${CMDCOL}+%s${DEFCOL}'; %s\n"
+                             % (cmd, cmd))
 
         # For make < 4.3 and multiple outputs, must create rule for each output
         if not self.new_version:
@@ -177,32 +625,100 @@ class Workflow():
                 cmd_add_output = "if test -f $@; then touch -h $@; else if [ -f $^ ]; then rm -f $^ && ${MAKE} $^; fi; fi"
 
                 for k in range(1,len(outputs)):
-                    self.f.write("\n%s : %s\n" % (outputs[k], outputs[k-1]))
-                    self.f.write("\t@%s\n" % cmd_add_output)
+                    lines.append("\n%s : %s\n" % (outputs[k], outputs[k-1]))
+                    lines.append("\t@%s\n" % cmd_add_output)
 
-        ## Need to update the MAIN function to add new outputs ##
-        # Only if outputs are not secondary (intermediate) files
-        if not secondary:
-            # Read the text and replace MAIN
-            filetext = ''
-            self.f.seek(0)
-            for line in self.f:
-                if line[:4] == 'MAIN':
-                    line = ' '.join([line.rstrip(), *outputs, '\n'])
-                    filetext += line
-                else:
-                    filetext += line
+        # if files are secondary, need to specify
+        # Buffered workflows instead collect them in self._secondaries and
+        # emit a single consolidated .SECONDARY line at render time
+        if secondary and not self._buffered:
+            lines.append("\n.SECONDARY : %s\n" % (' '.join(outputs)))
 
-            # Write to file
-            f = open(self.filename, 'w')
-            f.write(filetext)
-            f.flush()
-            self.f = open(self.filename, 'a+')
+        return ''.join(lines)
 
-        # if files are secondary, need to specify
-        else:
-            self.f.write("\n.SECONDARY : %s\n" % (' '.join(outputs)))
-            self.f.flush()
+    def _format_ninja_rule(self, cmds, inputs, outputs, title, soft_inputs,
+                           verbose):
+        """
+        Build the ninja text for one rule (a numbered rule block with its
+        command, then a build line) and return it as a single string.
+        Arguments must already be normalized.
+        """
+        cmds = check_args_cmd(cmds)
+
+        if not verbose:
+            cmds = [cmd + ' 1> /dev/null' for cmd in cmds]
+
+        # One rule block per append; ninja runs the command through a
+        # shell, so several commands are chained with &&
+        self._rule_count += 1
+        name = 'r%d' % self._rule_count
+        lines = ["\nrule %s\n" % name,
+                 "  command = %s\n" % ' && '.join(cmds)]
+        if title is not None:
+            lines.append("  description = %s\n" % title)
+
+        # Build line; soft inputs map to ninja's order-only dependencies
+        build = "build %s: %s" % (' '.join(outputs), name)
+        if len(inputs) > 0:
+            build += ' ' + inputs
+        if len(soft_inputs) > 0:
+            build += ' || ' + soft_inputs
+        lines.append(build + '\n')
+
+        return ''.join(lines)
+
+    def register_template(self, name, cmds, inputs, outputs,
+                          title=None, secondary=False, verbose=True):
+        """
+        Register a reusable rule template under the given name.
+        cmds, inputs and outputs may contain %(key)s placeholders; the rule
+        text is precompiled once here, so each append_template call only
+        pays a single formatting operation instead of rebuilding the whole
+        rule. Useful for pipelines emitting thousands of near-identical
+        rules (e.g. per-tile processing).
+        """
+        # Templates hold make-syntax text
+        if self.backend == 'ninja':
+            raise ValueError("templates are not supported with "
+                             "backend='ninja'")
+
+        outputs = check_args_output(outputs)
+        inputs = check_args_inout(inputs)
+        # use_cache=False: a single cache key cannot cover the different
+        # instantiations of a template
+        text = self._format_rule(cmds, inputs, outputs, title,
+                                 secondary, '', verbose, use_cache=False)
+        self._templates[name] = (text, outputs, secondary)
+
+    def append_template(self, name, **params):
+        """
+        Add a rule from the template registered under name, substituting
+        the %(key)s placeholders with the given keyword arguments.
+        """
+        text, outputs, secondary = self._templates[name]
+        self._write(text % params)
+
+        # Secondary outputs of buffered workflows go in the consolidated
+        # .SECONDARY line, see append()
+        if secondary and self._buffered:
+            self._secondaries.extend(output % params for output in outputs)
+
+        # Update MAIN with the substituted outputs
+        if not secondary and not self._targets_frozen:
+            outputs = [output % params for output in outputs]
+            if self._buffered:
+                self._main_outputs.extend(outputs)
+            else:
+                self._update_main(outputs)
+
+    def append_many(self, rules):
+        """
+        Add several rules to the Makefile at once.
+        rules is a list of dictionaries of keyword arguments for append(),
+        e.g. [{'cmds': ..., 'inputs': ..., 'outputs': ...}, ...].
+        """
+        for rule in rules:
+            self.append(**rule)
 
     def clean(self, cmds):
         """
@@ -210,70 +726,174 @@ class Workflow():
         commands as part of the workflow.
         Commands can be a single command or a list of commands.
         """
+        # The clean target is make-syntax text
+        if self.backend == 'ninja':
+            raise ValueError("clean is not supported with backend='ninja'")
 
-        # Write clean line
-        self.f.write("\nclean : \n")
+        # Collect the clean target and all commands, then write in one call
+        lines = ["\nclean : \n"]
 
-        # Add all commands
         cmds = check_args_cmd(cmds)
 
         for cmd in cmds:
-            # print command with + symbol and green color
-            self.f.write("\t-@echo '${CMDCOL}+%s${DEFCOL}'\n" % cmd)
+            # print command with + symbol and green color, then run it,
+            # on a single recipe line. '|| true' keeps one failing step
+            # from aborting the rest, as the whole recipe runs in a
+            # single -e shell under .ONESHELL
+            lines.append("\t@echo '${CMDCOL}+%s${DEFCOL}'; %s || true\n"
+                         % (cmd, cmd))
 
-            # command to be run
-            self.f.write("\t@%s\n" % cmd)
-            self.f.flush()
+        self._write(''.join(lines))
 
     def display(self):
         """
         Print the current makefile to the screen.
         """
-        self.f.seek(0)
-        filetext = self.f.read()
-        print(filetext)
+        # Buffered workflows are printed straight from memory, without
+        # writing to and reading back from the file
+        if self._buffered:
+            print(self._render())
+        else:
+            self._flush_main()
+            with open(self.filename) as f:
+                print(f.read())
 
     def run(self, njobs=1, dryrun=False, debug=False, ignore_err=True,
             force=False, clean=False, other_args=None):
         """
         Run the makefile with njobs parallel jobs.
-        njobs: int, number of parallel jobs to run.
+        Raise TypeError if njobs is not an int, so callers embedding this in
+        a larger pipeline can catch the error instead of the interpreter
+        exiting.
+        Note that when run() is itself called from a recipe of an outer
+        'make -jN', make's jobserver is inherited through MAKEFLAGS, so
+        nested workflows share the outer job pool instead of oversubscribing.
+        njobs: int, number of parallel jobs to run. Set to None to use one
+        job per CPU. A bare -j (unlimited jobs) is deliberately never
+        passed, as it breaks jobserver coordination with sub-makes.
         dryrun: bool, set to True to print the commands without running them.
         debug: bool, set to True to run in debug mode.
         ignore_err: bool, set to True to continue the workflow even if errors
-        are detected (recommended if several independent steps are running)
+        are detected (recommended if several independent steps are running).
+        Note that this applies across rules only: each rule runs as a single
+        bash -e script (.ONESHELL), so within a rule the commands after a
+        failing one are skipped, and the other rules carry on.
         force: bool, set to True to re-run all the commands
         clean: bool, set to True to run the clean command as well
         other_args: str, any other argument to pass to make
+        With backend='ninja', dryrun, debug and ignore_err map to the
+        equivalent ninja flags and force/clean are ignored.
+        Returns the build tool's exit code, so callers can check whether
+        the workflow succeeded.
         """
-        cmd = "make -f %s" % self.filename
-
-        # Check njobs option and append
-        if isinstance(njobs, int):
-            if njobs > 1:
-                cmd += ' -j %i' % njobs
+        # Check njobs option
+        # None means one job per CPU
+        if njobs is None:
+            njobs = os.cpu_count()
+        if not isinstance(njobs, int):
+            raise TypeError("njobs must be of type int")
+
+        # Ninja reads its file from disk and maps onto a smaller option set
+        if self.backend == 'ninja':
+            self._materialize()
+            argv = ['ninja', '-f', self.filename, '-j', str(njobs)]
+            if dryrun:
+                argv.append('-n')
+            if debug:
+                argv.append('-v')
+            if ignore_err:
+                argv += ['-k', '0']
+            if other_args is not None:
+                argv += shlex.split(other_args)
+            return subprocess.run(argv).returncode
+
+        # Temporary-file workflows are piped straight to make's stdin, so
+        # the makefile text never has to round-trip through the filesystem.
+        # Workflows with a user-supplied filename are written to disk first.
+        # Extra goals like 'list' only arrive through other_args and re-read
+        # the makefile ($(MAKEFILE_LIST)), which for stdin input is a
+        # temporary copy already deleted after parsing - so keep those on
+        # the on-disk path.
+        use_stdin = (self._buffered and hasattr(self, 'tmpf')
+                     and other_args is None)
+        if use_stdin:
+            makefile = '-'
         else:
-            print("ERROR: njobs must be of type int")
-            sys.exit()
+            self._materialize()
+            makefile = self.filename
+
+        # Build make arguments as an argv list, so no shell is needed
+        argv = ['make', '-f', makefile]
+
+        if njobs > 1:
+            argv += ['-j', str(njobs)]
+            # --output-sync groups the output of each parallel recipe so
+            # logs stay readable, but only exists from make 4.0 on, while
+            # older makes (single-output fallback) must still run in
+            # parallel without it. A new (grouped targets) make implies
+            # support without re-spawning make -v when assume_new_make
+            # was given.
+            if self.new_version or get_make_version() >= _VERSION_4_0:
+                argv.append('-Orecurse')
 
         # Append other options
         if dryrun:
-            cmd += ' -n --no-print-directory'
+            argv += ['-n', '--no-print-directory']
         if debug:
-            cmd += ' -d'
+            argv.append('-d')
         if ignore_err:
-            cmd += ' -i'
+            argv.append('-i')
         if force:
-            cmd += ' -B'
+            argv.append('-B')
         if clean:
-            cmd += ' clean'
+            argv.append('clean')
 
         # Allow any other arguments to be passed
         if other_args is not None:
-            cmd += ' ' + other_args
+            argv += shlex.split(other_args)
 
-        # Run make
-        subprocess.run(cmd, shell=True)
+        # Run make directly, without an intermediate shell
+        # The makefile text is encoded once and fed to make as raw bytes
+        if use_stdin:
+            result = subprocess.run(argv,
+                                    input=self._render().encode('utf-8'))
+        else:
+            result = subprocess.run(argv)
+
+        return result.returncode
+
+
+def _build_one(spec):
+    """
+    Build and materialize a single workflow from a spec dictionary.
+    Used by build_workflows_parallel, must be picklable hence module-level.
+    """
+    wf = Workflow(spec['filename'], spec.get('title'), overwrite=True)
+    for step in spec['steps']:
+        wf.append(**step)
+    wf._materialize()
+    return wf.filename
+
+
+def build_workflows_parallel(specs, njobs=None):
+    """
+    Generate several independent makefiles in parallel, one per spec.
+    Each spec is a dict with a 'filename' key, an optional 'title' key and a
+    'steps' key holding a list of keyword-argument dicts for Workflow.append.
+    Since each workflow writes its own file, generation is embarrassingly
+    parallel. Child processes are started with the 'spawn' method rather
+    than the default 'fork', so a large parent process (e.g. holding numpy
+    arrays) is not duplicated.
+    njobs: int, number of worker processes (Default is None, i.e. one per CPU)
+    Returns the list of generated makefile paths.
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    ctx = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=njobs,
+                                                mp_context=ctx) as executor:
+        return list(executor.map(_build_one, specs))
 
 
 def check_args_inout(args):
@@ -281,21 +901,21 @@ def check_args_inout(args):
     Accepted arguments for input/outputs are string (in case a single input/output), or some kind of list (list, tuple, numpy array). Convert the latter into a string with a space delimiter for the makefile.
     Remove redundant slashes in filenames as it will be recognized as a different file by make.
     """
-    # To comply with both Python3 and 2, string must be detected first
-    # in Python3, string have __iter__ attribute too
+    # String must be detected first as strings are iterable too
     if isinstance(args, str):
         if len(args) > 0:   # exclude empty string
-            args = os.path.normpath(args)
-    # should work for list, tuples, numpy arrays
-    elif hasattr(args, '__iter__'):
-        args = [os.path.normpath(arg) for arg in args]
-        args = ' '.join(args)
+            args = _normpath(args)
+    # isinstance is a single C-level type check, much cheaper than
+    # probing for an __iter__ attribute
+    elif isinstance(args, (list, tuple)):
+        args = ' '.join(map(_normpath, args))
     else:
-        print("ERROR: argument must be iterable (list, tuple, array). \
-        Currently set to:")
-        print(args)
-        traceback.print_stack()
-        sys.exit()
+        # other iterables, e.g. numpy arrays; rejects anything else
+        try:
+            args = ' '.join(map(_normpath, list(args)))
+        except TypeError:
+            raise TypeError("argument must be str or iterable (list, tuple, "
+                            "array), got %s" % type(args).__name__)
 
     return args
 
@@ -305,22 +925,23 @@ def check_args_output(args):
     Accepted arguments for outputs are string (in case a single output), or some kind of list (list, tuple, numpy array). Convert all into a list.
     Remove redundant slashes in filenames as it will be recognized as a different file by make.
     """
-    # To comply with both Python3 and 2, string must be detected first
-    # in Python3, string have __iter__ attribute too
+    # String must be detected first as strings are iterable too
     if isinstance(args, str):
         if len(args) > 0:   # exclude empty string
-            args = [os.path.normpath(args)]
+            args = [_normpath(args)]
         else:
             args = []
-    # should work for list, tuples, numpy arrays
-    elif hasattr(args, '__iter__'):
-        args = [os.path.normpath(arg) for arg in args]
+    # isinstance is a single C-level type check, much cheaper than
+    # probing for an __iter__ attribute
+    elif isinstance(args, (list, tuple)):
+        args = list(map(_normpath, args))
     else:
-        print("ERROR: argument must be str or iterable (list, tuple, array). \
-        Currently set to:")
-        print(args)
-        traceback.print_stack()
-        sys.exit()
+        # other iterables, e.g. numpy arrays; rejects anything else
+        try:
+            args = list(map(_normpath, list(args)))
+        except TypeError:
+            raise TypeError("argument must be str or iterable (list, tuple, "
+                            "array), got %s" % type(args).__name__)
 
     return args
 
@@ -329,27 +950,42 @@ def check_args_cmd(args):
     """
     Accepted commands for all functions are string (in case a single command), or some kind of list (list, tuple, numpy array). Convert both cases to list.
     """
-    # To comply with both Python3 and 2, string must be detected first
-    # in Python3, string have __iter__ attribute too
+    # String must be detected first as strings are iterable too
     if isinstance(args, str):
         args = [args, ]
-    elif hasattr(args, '__iter__'):  # if arg is iterable
+    # isinstance is a single C-level type check, much cheaper than
+    # probing for an __iter__ attribute
+    elif isinstance(args, (list, tuple)):
         pass
     else:
-        print("ERROR: argument must be iterable (list, tuple, array) \
-        or string")
-        print(args)
-        sys.exit()
+        # other iterables, e.g. numpy arrays or generators; materializing
+        # them here makes sure they can be iterated over more than once
+        try:
+            args = list(args)
+        except TypeError:
+            raise TypeError("argument must be str or iterable (list, tuple, "
+                            "array), got %s" % type(args).__name__)
 
     return args
 
 
+# Translation table for escape_char, built once at import time
+# Maybe more characters will need to be added.
+_ESCAPE_TABLE = str.maketrans({"'": "\\'",    # escape '
+                               '"': '\\"',    # escape "
+                               "\n": "\\n"})  # escape \n
+
+# Detects whether a string contains any character needing escaping,
+# so the common case (plain titles) can skip translation entirely
+_NEEDS_ESCAPE = re.compile(r'["\'\n]')
+
+
 def escape_char(string):
     """
     Escape special characters from string before passing to makefile.
-    Maybe more characters will need to be added.
+    Strings without special characters are returned as is; others are
+    translated in a single pass with a precomputed table.
     """
-    string = string.replace("'", "\\'")  # escape '
-    string = string.replace('"', '\\"')  # escape "
-    string = string.replace("\n", "\\n")  # escape \n
-    return string
+    if _NEEDS_ESCAPE.search(string) is None:
+        return string
+    return string.translate(_ESCAPE_TABLE)
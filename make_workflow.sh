@@ -50,3 +50,16 @@ function makefile_secondary {
     printf ".SECONDARY : $2\n" >> $1
 }
 
+
+function makefile_run {
+    # Usage: makefile_run filename [njobs]
+    # Run the makefile with njobs parallel jobs (default 1).
+    # make is executed directly, without spawning an extra shell.
+    if [ -z "$2" ] || [ "$2" -le 1 ]
+    then
+	make -f $1
+    else
+	make -f $1 -j $2
+    fi
+}
+
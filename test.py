@@ -76,3 +76,22 @@ wf.clean(['rm -f bye2', 'rm -f bye3'])
 # Create and run workflow - second call runs the clean commands
 wf.run(njobs=1)
 wf.run(njobs=1, clean=True)
+
+
+## Test flow 5 - artifact cache ##
+
+# Initialize workflow with an artifact cache
+wf = mw.Workflow(title="*** Test flow 5 - Artifact cache ***", overwrite=True, cache_dir='cache')
+
+# Create an output from an input file
+with open('in1', 'w') as f:
+    f.write('v1\n')
+wf.append("cp in1 out1", "in1", "out1", title='\n** out1 **')
+wf.run(njobs=1)
+
+# Change the input and re-run: out1 must be rebuilt from the new content,
+# not restored from the stale cached artifact
+with open('in1', 'w') as f:
+    f.write('v2\n')
+wf.run(njobs=1)
+assert open('out1').read() == 'v2\n', "stale artifact copied from cache"
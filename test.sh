@@ -15,4 +15,4 @@ makefile_append Makefile "Hello2" hello2 hello1 "sed 's/foo/faa/' hello1 > hello
 makefile_append Makefile "Hello3" hello3 "" "echo bar > hello3"
 
 # Finaly, create and run workflow
-make -f Makefile
+makefile_run Makefile